@@ -1 +1 @@
-from .core import DEM, ElevationProfile
+from .core import DEM, ElevationProfile, open_dem
@@ -1,21 +1,38 @@
 from __future__ import annotations
 
-from typing import Union, Tuple, List, Optional
+from functools import lru_cache
+from typing import Union, Tuple, Optional
 
 import geopandas as gpd
 import numpy as np
 import pandas as pd
 import rasterio
+import shapely
 from geopandas import GeoSeries
 from numpy import ndarray
 from pandas import DataFrame
 from pyproj import CRS
-from scipy import interpolate
+from rasterio.windows import Window
+from scipy import ndimage
 from scipy.signal import argrelextrema
+from scipy.signal import fftconvolve
+from scipy.signal import savgol_coeffs
 from scipy.signal import savgol_filter
 from shapely.geometry import LineString
 from shapely.geometry import Point
 
+# padding of the raster before computing the spline coefficients, same as map_coordinates(mode='nearest')
+_SPLINE_PAD = 12
+
+# size of the tiles for which the spline coefficients are computed
+_SPLINE_TILE = 256
+
+try:
+    from numba import njit
+except ImportError:
+    # numba is optional, without it the brunnel scan runs in plain python
+    njit = None
+
 
 class ElevationProfile:
 
@@ -112,54 +129,21 @@ class ElevationProfile:
 
             # construct brunnels in steep regions
 
-            diff_kernel = [1] + [0 for _ in range(diff_kernel_dist - 1)] + [-1]
-            # diff_kernel = np.array([1,0, -1])
-            diff = np.convolve(np.array(elevation), diff_kernel, 'same')
-
-            start_dists = []
-            end_dists = []
-            brunnel_types = []
-
-            i = 0
-            while i < len(elevation) - 1:
-
-                # bridge when downhill
-                if diff[i] < (construct_brunnel_thresh * (-1)):
-
-                    # get maximim in the next 200m
-                    max_i = min(i + 1 + int(max_brunnel_length / distance_delta), len(elevation))
-                    # print(i, max_i, distances[i], distances[max_i])
-
-                    # DEBUG
-                    if i + 1 >= max_i:
-                        print(i + 1, max_i, len(elevation) - 1)
-
-                    assert (i + 1 < max_i)
-
-                    # get the idx if the maximum in the next 200m
-                    max_idx = np.argmax(elevation[i + 1:max_i])
-                    max_idx = max_idx + i + 1
-                    # print("max_idx ", max_idx)
-                    # print("------")
-                    start_dists.append(distances[i])
-                    end_dists.append(distances[max_idx])
-                    brunnel_types.append("bridge")
+            elevation = np.asarray(elevation, dtype=np.float64)
 
-                # tunnel bei aufstieg
-                elif diff[i] > construct_brunnel_thresh:
+            # difference to the elevation diff_kernel_dist sample points before, centered on the sample point.
+            # at the boundaries where there is no sample point to take the difference to the difference is 0.
+            diff_offset = diff_kernel_dist // 2
+            diff = np.zeros_like(elevation)
+            diff[diff_kernel_dist - diff_offset:len(elevation) - diff_offset] = \
+                elevation[diff_kernel_dist:] - elevation[:-diff_kernel_dist]
 
-                    max_i = min(i + 1 + int(max_brunnel_length / distance_delta), len(elevation))
+            # for each steep sample point get the sample point where the brunnel should end
+            start_idx, end_idx, n_brunnels = _scan_brunnels(elevation, diff, float(construct_brunnel_thresh),
+                                                            int(max_brunnel_length / distance_delta))
 
-                    assert (i + 1 < max_i)
-
-                    # get minimum in the next 200m
-                    max_idx = np.argmin(elevation[i + 1:max_i])
-                    max_idx = max_idx + i + 1
-                    start_dists.append(distances[i])
-                    end_dists.append(distances[max_idx])
-                    brunnel_types.append("tunnel")
-
-                i += 1
+            start_dists = distances[start_idx[:n_brunnels]]
+            end_dists = distances[end_idx[:n_brunnels]]
 
             # merge overlapping brunnels
 
@@ -168,12 +152,12 @@ class ElevationProfile:
             # print(start_dists)
             # print(end_dists)
 
-            start_dists, end_dists = _filter_overlapping(start_dists.copy(), end_dists.copy())
+            start_dists, end_dists = _filter_overlapping(start_dists, end_dists)
 
             brunnel_types = ["constructed" for _ in start_dists]
 
             data = {"brunnel": brunnel_types, "start_dist": start_dists, "end_dist": end_dists,
-                    "length": np.array(end_dists) - np.array(start_dists)}
+                    "length": end_dists - start_dists}
             constructed_brunnels = pd.DataFrame(data)
 
             # filter small brunnels
@@ -182,104 +166,85 @@ class ElevationProfile:
             # check if constructed brunnel overlaps with real brunnel
             # if overlaps --> discard
 
-            drop_idx = []
-            for idx, brunnel in constructed_brunnels.iterrows():
-                start_in_brunnel = (brunnel.start_dist >= brunnels['start_dist']) & (
-                        brunnel.start_dist <= brunnels['end_dist'])
-                end_in_brunnel = (brunnel.end_dist >= brunnels['start_dist']) & (
-                        brunnel.end_dist <= brunnels['end_dist'])
+            # compare all constructed brunnels (rows) with all real brunnels (columns) at once
+            constructed_start = constructed_brunnels['start_dist'].values[:, np.newaxis]
+            constructed_end = constructed_brunnels['end_dist'].values[:, np.newaxis]
+            brunnel_start = brunnels['start_dist'].values[np.newaxis, :]
+            brunnel_end = brunnels['end_dist'].values[np.newaxis, :]
 
-                # chick if constructed a brunnel arround an existing one
-                # check if start is smaller than start and end ist larger than end
-                around_brunnel = (brunnel.start_dist <= brunnels['start_dist']) & (
-                        brunnel.end_dist >= brunnels['end_dist'])
+            start_in_brunnel = (constructed_start >= brunnel_start) & (constructed_start <= brunnel_end)
+            end_in_brunnel = (constructed_end >= brunnel_start) & (constructed_end <= brunnel_end)
 
-                if np.sum(start_in_brunnel | end_in_brunnel | around_brunnel) > 0:
-                    drop_idx.append(idx)
+            # chick if constructed a brunnel arround an existing one
+            # check if start is smaller than start and end ist larger than end
+            around_brunnel = (constructed_start <= brunnel_start) & (constructed_end >= brunnel_end)
 
-            constructed_brunnels = constructed_brunnels.drop(drop_idx)
+            overlaps = np.any(start_in_brunnel | end_in_brunnel | around_brunnel, axis=1)
+            constructed_brunnels = constructed_brunnels[~overlaps]
 
-            # merge with other brunnels and sort
+            # merge with other brunnels
             brunnels = pd.concat([brunnels, constructed_brunnels], ignore_index=True)
 
-            brunnels = brunnels.sort_values("start_dist")
-            brunnels = brunnels.reset_index(drop=True)
-
         if brunnels.shape[0] == 0:
             return self
 
-        start_dists = brunnels['start_dist'].values
-        end_dists = brunnels['end_dist'].values
+        brunnels = brunnels.sort_values("start_dist")
+        brunnels = brunnels.reset_index(drop=True)
+
+        start_dists = brunnels['start_dist'].to_numpy(dtype=np.float64)
+        end_dists = brunnels['end_dist'].to_numpy(dtype=np.float64)
+
+        n_samples = len(elevation)
 
+        # range of the sample points in each brunnel, a sample point belongs to the last brunnel that starts before it
+        sample_from = np.searchsorted(distances, start_dists, side='left')
+        sample_to = np.minimum(np.searchsorted(distances, end_dists, side='right'),
+                               np.append(sample_from[1:], n_samples))
+
+        # index of the sample point before and after each brunnel
+        start_idx = np.round(start_dists / distance_delta).astype(np.intp) - 1
+        end_idx = np.round(end_dists / distance_delta).astype(np.intp) + 1
+
+        # linearly interpolate between start and end point of each brunnel
+        # take into account buffer
+        p1_dists = start_dists - distance_delta
+        p2_dists = end_dists + distance_delta
+
+        # the brunnels are interpolated in order and the start and end elevations are taken from the already
+        # interpolated elevations, so a brunnel right after another one starts at its interpolated elevation
         ele_brunnel = elevation.copy()
-        for i, x in enumerate(distances):
-
-            # if x in brunnel
-            # get index of brunnel
-            idx = np.argwhere((x >= start_dists) & (x <= end_dists))
-
-            assert idx.size <= 1
-
-            # DEBUG
-            if idx.size > 1:
-                print(x, idx, len(end_dists), brunnels.shape)
-                print(brunnels.iloc[idx[0]])
-                print(brunnels.iloc[idx[1]])
-
-            if idx.size == 1:
-
-                idx = idx[0][0]
-
-                # get index of elevation data
-                start_idx = np.int64(round((start_dists[idx]) / distance_delta) - 1)
-                end_idx = np.int64(round((end_dists[idx]) / distance_delta) + 1)
-
-                start_ele = None
-                end_ele = None
-
-                # if trip doesnt start with brunnel
-                if start_idx > 0:
-                    if type(start_idx) != np.int64 and \
-                            type(start_idx) != np.int32 and \
-                            type(start_idx) != int:
-                        print(start_idx)
-                        print(ele_brunnel.shape)
-                        print(type(start_idx))
-                    start_ele = ele_brunnel[start_idx]
-
-                # if trip doesnt end with brunnel:
-                if end_idx < len(ele_brunnel) - 1:
-                    end_ele = ele_brunnel[end_idx]
-
-                # if trip start with brunnel
-                if start_ele is None:
-                    start_ele = end_ele
-
-                # if trip ends with brunnel
-                if end_ele is None:
-                    end_ele = start_ele
-
-                # if trip is completely brunnel
-                if start_ele is None and end_ele is None:
-                    # then take ele at start and ele at end as elevations
-                    start_idx = 0
-                    end_idx = round(end_dists[-1] / distance_delta)
-                    start_ele = ele_brunnel[start_idx]
-                    end_ele = ele_brunnel[end_idx]
-
-                assert start_ele is not None
-                assert end_ele is not None
-
-                # linearly interpolate between start and end point
-                # take into account buffer
-                p1 = (start_dists[idx] - distance_delta, start_ele)
-                p2 = (end_dists[idx] + distance_delta, end_ele)
-
-                m = (p2[1] - p1[1]) / (p2[0] - p1[0])
-                c = p1[1] - m * p1[0]
-                ele_brunnel[i] = m * x + c
-
-            self.elevations = ele_brunnel
+        for i in np.flatnonzero(sample_from < sample_to):
+
+            start_ele = None
+            end_ele = None
+
+            # if trip doesnt start with brunnel
+            if start_idx[i] > 0:
+                start_ele = ele_brunnel[start_idx[i]]
+
+            # if trip doesnt end with brunnel:
+            if end_idx[i] < n_samples - 1:
+                end_ele = ele_brunnel[end_idx[i]]
+
+            # if trip starts with brunnel
+            if start_ele is None:
+                start_ele = end_ele
+
+            # if trip ends with brunnel
+            if end_ele is None:
+                end_ele = start_ele
+
+            # if trip is completely brunnel then take ele at start and ele at end as elevations
+            if start_ele is None:
+                start_ele = ele_brunnel[0]
+                end_ele = ele_brunnel[min(round(end_dists[-1] / distance_delta), n_samples - 1)]
+
+            m = (end_ele - start_ele) / (p2_dists[i] - p1_dists[i])
+            c = start_ele - m * p1_dists[i]
+
+            ele_brunnel[sample_from[i]:sample_to[i]] = m * distances[sample_from[i]:sample_to[i]] + c
+
+        self.elevations = ele_brunnel
         return self
 
     def to_terrain_model(self, method: str = "variance",
@@ -315,10 +280,15 @@ class ElevationProfile:
         distances = self.distances.copy()
 
         if method == "variance":
-            elevation = pd.Series(elevation)
-            t = elevation.rolling(window_size).std()
-            elevation[t > std_thresh] = elevation[t > std_thresh] - np.clip(t[t > std_thresh] * sub_factor, 0, clip)
-            elevation = elevation.values
+            if njit is not None:
+                elevation = _subtract_rolling_std(np.asarray(elevation, dtype=np.float64), window_size, std_thresh,
+                                                  sub_factor, clip)
+            else:
+                elevation = np.asarray(elevation, dtype=np.float64)
+                t = pd.Series(elevation).rolling(window_size).std().to_numpy()
+
+                # subtract in place only where the std is above the threshold
+                np.subtract(elevation, np.clip(t * sub_factor, 0, clip), out=elevation, where=t > std_thresh)
         elif method == "minimum":
             for _ in range(minimum_loops):
                 minima = argrelextrema(elevation, np.less)
@@ -334,7 +304,36 @@ class ElevationProfile:
         return self
 
     def smooth(self, window_size: int = 301, poly_order: int = 3, mode: str = "nearest") -> ElevationProfile:
-        self.elevations = savgol_filter(self.elevations, window_size, poly_order, mode=mode)
+        """
+        Smooths the elevation with a Savitzky-Golay filter.
+
+        Parameters
+        ----------
+
+            window_size : int
+                the window size of the filter in sample points
+            poly_order : int
+                the order of the polynomial fitted in each window
+            mode : str
+                the boundary handling, see scipy.signal.savgol_filter
+
+        Returns
+        -------
+        """
+
+        elevation = np.asarray(self.elevations, dtype=np.float64)
+
+        # np.pad modes that extend the profile like the savgol_filter modes
+        pad_modes = {"nearest": "edge", "mirror": "reflect", "wrap": "wrap", "constant": "constant"}
+
+        # for large windows the fft convolution is faster than the direct convolution of savgol_filter
+        if mode in pad_modes and window_size % 2 == 1 and 200 < window_size < len(elevation):
+            half_window = window_size // 2
+            padded = np.pad(elevation, half_window, mode=pad_modes[mode])
+            self.elevations = fftconvolve(padded, savgol_coeffs(window_size, poly_order), mode='valid')
+        else:
+            self.elevations = savgol_filter(elevation, window_size, poly_order, mode=mode)
+
         return self
 
     def resample(self, distance: Union[float, ndarray]) -> ElevationProfile:
@@ -351,12 +350,12 @@ class ElevationProfile:
         -------
         """
 
-        elevation = self.elevations.copy()
-        distances = self.distances.copy()
+        elevation = np.ascontiguousarray(self.elevations, dtype=np.float64)
+        distances = np.ascontiguousarray(self.distances, dtype=np.float64)
 
         if np.isscalar(distance):
-            distances_interpolated = np.arange(0, distances[-1], distance)
-            distances_interpolated = np.append(distances_interpolated, distances[-1])
+            # the last element of arange is smaller than the last distance, so the last distance is always appended
+            distances_interpolated = np.concatenate((np.arange(0.0, distances[-1], distance), distances[-1:]))
         elif type(distance) is np.ndarray:
             distances_interpolated = distance
         else:
@@ -381,22 +380,20 @@ class ElevationProfile:
             Numpy array
                 Inclination in promille or degrees. n-1 points returned (inclination between the distances).
         """
-        elevation = self.elevations
-        distances = self.distances
-
-        slopes = []
+        elevation = np.asarray(self.elevations, dtype=np.float64)
+        distances = np.asarray(self.distances, dtype=np.float64)
 
         # https://www.omnicalculator.com/construction/elevation-grade
-        for i in range(len(elevation) - 1):
-            rise = elevation[i + 1] - elevation[i]
-            run = distances[i + 1] - distances[i]
+        rise = np.diff(elevation)
+        run = np.diff(distances)
 
-            if degrees:
-                slopes.append(np.arctan(rise / run))
-            else:
-                slopes.append(rise / run * 1000)
+        # zero length segments have no inclination
+        slopes = np.divide(rise, run, out=np.zeros_like(rise), where=run != 0)
 
-        return np.array(slopes)
+        if degrees:
+            return np.arctan(slopes)
+
+        return slopes * 1000
 
     def cumulative_ascent(self, ascending=True) -> float:
 
@@ -454,19 +451,142 @@ class DEM:
 
     """
 
-    def __init__(self, file: str, elevation_band: int = 1):
+    def __init__(self, file: str, elevation_band: int = 1, window: Optional[Window] = None):
         """
         Parameters
         ----------
             file : str
                 location to geotiff with elevation data
+            elevation_band : int
+                the band of the geotiff that contains the elevation
+            window : Window
+                default None. If given only this window of the raster is loaded into memory, e.g. the window around a
+                trip. The window is enlarged to the block boundaries of the geotiff. Interpolated samples outside of
+                the window raise a ValueError, non interpolated samples outside of the window are read from the file.
+                Samples outside of the raster always raise a ValueError.
         """
 
         self.dem = rasterio.open(file)
-        self.elev = self.dem.read(elevation_band)
+        self._band = elevation_band
+        self._block_shape = self.dem.block_shapes[elevation_band - 1]
+
+        # pixels around the interpolated area that the spline coefficients depend on
+        halo = _SPLINE_PAD + 2
+
+        if window is not None:
+            # read a halo around the window, so that interpolated samples in the window are the same as with the whole
+            # raster. enlarge it to whole blocks, so that no block is read partially
+            block_height, block_width = self._block_shape
+            row_off = max(int((window.row_off - halo) // block_height * block_height), 0)
+            col_off = max(int((window.col_off - halo) // block_width * block_width), 0)
+            row_end = min(int(np.ceil((window.row_off + window.height + halo) / block_height) * block_height),
+                          self.dem.height)
+            col_end = min(int(np.ceil((window.col_off + window.width + halo) / block_width) * block_width),
+                          self.dem.width)
+            window = Window(col_off, row_off, col_end - col_off, row_end - row_off)
+
+        self.elev = self.dem.read(elevation_band, window=window)
+
+        # transformation of the loaded part of the raster
+        self._transform = self.dem.transform if window is None else self.dem.window_transform(window)
+        # range of the pixel center row / col that can be interpolated. Inside of the raster the halo must be loaded,
+        # at the edges of the raster up to the outer pixel edge.
+        height, width = self.elev.shape
+        if window is None:
+            self._interp_bounds = (-0.5, height - 0.5, -0.5, width - 0.5)
+        else:
+            self._interp_bounds = (halo - 0.5 if window.row_off > 0 else -0.5,
+                                   height - halo - 0.5 if window.row_off + height < self.dem.height else height - 0.5,
+                                   halo - 0.5 if window.col_off > 0 else -0.5,
+                                   width - halo - 0.5 if window.col_off + width < self.dem.width else width - 0.5)
+
         self.crs = CRS.from_wkt(self.dem.crs.to_wkt())
+        self._epsg = self.crs.to_epsg()
 
-        print("Loaded dem as EPSG:" + str(self.crs.to_epsg()))
+        print("Loaded dem as EPSG:" + str(self._epsg))
+
+    def _interpolate(self, rows: ndarray, cols: ndarray) -> ndarray:
+        """
+        Bicubic spline interpolation of the loaded raster.
+
+        The spline coefficients are only computed for the tiles of _SPLINE_TILE pixels that contain samples, with a halo
+        of _SPLINE_PAD + 2 pixels around each tile, so the memory does not grow with the size of the raster. At the
+        edges of the raster the tile is padded like map_coordinates(mode='nearest', prefilter=True) does.
+
+        Nodata pixels are filled with the nearest valid elevation before filtering, so that they do not spread.
+        Samples with a nodata pixel in their 4x4 supporting pixels are nan.
+
+        Parameters
+        ----------
+            rows : ndarray
+                fractional rows of the samples, pixel centers are at whole numbers
+            cols : ndarray
+                fractional cols of the samples, pixel centers are at whole numbers
+
+        Returns
+        -------
+            ndarray
+            the interpolated elevations
+        """
+
+        height, width = self.elev.shape
+        halo = _SPLINE_PAD + 2
+        elevations = np.empty(len(rows), dtype=np.float64)
+
+        if len(rows) == 0:
+            return elevations
+
+        # group the samples by tile
+        tile_rows = np.clip(np.floor(rows), 0, height - 1).astype(np.intp) // _SPLINE_TILE
+        tile_cols = np.clip(np.floor(cols), 0, width - 1).astype(np.intp) // _SPLINE_TILE
+        tile_keys = tile_rows * (width // _SPLINE_TILE + 1) + tile_cols
+        order = np.argsort(tile_keys, kind='stable')
+        tiles = np.split(order, np.flatnonzero(np.diff(tile_keys[order])) + 1)
+
+        for idx in tiles:
+            row_from = max(tile_rows[idx[0]] * _SPLINE_TILE - halo, 0)
+            row_to = min((tile_rows[idx[0]] + 1) * _SPLINE_TILE + halo, height)
+            col_from = max(tile_cols[idx[0]] * _SPLINE_TILE - halo, 0)
+            col_to = min((tile_cols[idx[0]] + 1) * _SPLINE_TILE + halo, width)
+
+            tile = self.elev[row_from:row_to, col_from:col_to].astype(np.float64)
+
+            nodata = np.isnan(tile)
+            if self.dem.nodata is not None and not np.isnan(self.dem.nodata):
+                nodata |= tile == self.dem.nodata
+
+            if np.all(nodata):
+                tile[:] = 0
+            elif np.any(nodata):
+                # index of the nearest valid pixel for each pixel
+                nearest = ndimage.distance_transform_edt(nodata, return_distances=False, return_indices=True)
+                tile = tile[tuple(nearest)]
+
+            # pad like map_coordinates(mode='nearest', prefilter=True) does, so that the raster edges are the same
+            coeffs = ndimage.spline_filter(np.pad(tile, _SPLINE_PAD, mode='edge'), order=3, output=np.float64,
+                                           mode='nearest')
+
+            # https://docs.scipy.org/doc/scipy/reference/generated/scipy.ndimage.map_coordinates.html
+            tile_sample_rows = rows[idx] - row_from
+            tile_sample_cols = cols[idx] - col_from
+            elevations[idx] = ndimage.map_coordinates(coeffs, np.vstack([tile_sample_rows + _SPLINE_PAD,
+                                                                         tile_sample_cols + _SPLINE_PAD]),
+                                                      order=3, mode='nearest', prefilter=False)
+
+            # samples with a nodata pixel in their 4x4 supporting pixels are nodata
+            if np.any(nodata):
+                support_row_from = np.floor(tile_sample_rows).astype(np.intp) - 1
+                support_col_from = np.floor(tile_sample_cols).astype(np.intp) - 1
+
+                near_nodata = np.zeros(len(idx), dtype=bool)
+                for row_offset in range(4):
+                    for col_offset in range(4):
+                        near_nodata |= nodata[np.clip(support_row_from + row_offset, 0, nodata.shape[0] - 1),
+                                              np.clip(support_col_from + col_offset, 0, nodata.shape[1] - 1)]
+
+                elevations[idx[near_nodata]] = np.nan
+
+        return elevations
 
     def sample_point(self, point: Point, interpolated: bool = True) -> float:
         """
@@ -505,69 +625,71 @@ class DEM:
                 elevation at p_x, p_y
         """
 
-        # get the index of the raster pixel containing the point
-        row, col = self.dem.index(p_x, p_y)
+        return self.sample_coords_batch(np.array([p_x]), np.array([p_y]), interpolated=interpolated)[0]
+
+    def sample_coords_batch(self, xs: ndarray, ys: ndarray, interpolated: bool = True) -> ndarray:
+        """
+        Samples the elevation at many coordinates at once.
+
+        Parameters
+        ----------
+
+            xs : ndarray
+                x coordinates / longitudes
+            ys : ndarray
+                y coordinates / latitudes
+            interpolated : bool
+                Weather or not should be sampled from interpolated dem values.
+
+        Returns
+        -------
+            elevations : ndarray
+                elevation at each xs, ys
+        """
+
+        xs = np.asarray(xs, dtype=np.float64)
+        ys = np.asarray(ys, dtype=np.float64)
+
+        # fractional col / row of all points in one affine transformation
+        cols, rows = ~self._transform * (xs, ys)
 
         if not interpolated:
-            return self.elev[row, col]
-
-        # get raster pixel center
-        r_x, r_y = self.dem.xy(row, col)
-
-        row_from, row_to, col_from, col_to = None, None, None, None
-
-        # get the correct surrounding raster pixels, depending on point location in raster cell
-        if p_x <= r_x and p_y <= r_y:
-            row_from = -1
-            row_to = 2
-            col_from = -2
-            col_to = 1
-        if p_x >= r_x and p_y <= r_y:
-            row_from = -1
-            row_to = 2
-            col_from = -1
-            col_to = 2
-        if p_x >= r_x and p_y >= r_y:
-            row_from = -2
-            row_to = 1
-            col_from = -1
-            col_to = 2
-        if p_x <= r_x and p_y >= r_y:
-            row_from = -2
-            row_to = 1
-            col_from = -2
-            col_to = 1
-
-        assert row_from is not None
-        assert row_to is not None
-        assert col_from is not None
-        assert col_to is not None
-
-        row_from += row
-        row_to += row
-        col_from += col
-        col_to += col
-
-        # the 16 supporting points of the interpolattion
-        z = self.elev[row_from:row_to + 1, col_from:col_to + 1]
-        z = z.flatten()
-
-        # get the coordinates for each supporintg point
-        x_coors = []
-        y_coors = []
-        for row in range(row_from, row_to + 1):
-            for col in range(col_from, col_to + 1):
-                x, y = self.dem.xy(row, col)
-                x_coors.append(x)
-                y_coors.append(y)
-
-        # 5. interpolate cubic with scipy
-        # https://docs.scipy.org/doc/scipy/reference/generated/scipy.interpolate.interp2d.html
-        f = interpolate.interp2d(x_coors, y_coors, z, kind='cubic')
-
-        e = f(p_x, p_y)[0]
-
-        return e
+            file_cols, file_rows = ~self.dem.transform * (xs, ys)
+            if np.any((file_rows < 0) | (file_rows >= self.dem.height) |
+                      (file_cols < 0) | (file_cols >= self.dem.width)):
+                raise ValueError("Samples must lie inside of the DEM")
+
+            rows = np.floor(rows).astype(np.intp)
+            cols = np.floor(cols).astype(np.intp)
+
+            inside = (rows >= 0) & (rows < self.elev.shape[0]) & (cols >= 0) & (cols < self.elev.shape[1])
+
+            elevations = np.empty(len(xs), dtype=self.elev.dtype)
+            elevations[inside] = self.elev[rows[inside], cols[inside]]
+
+            # points outside of the loaded window are read from the file
+            if not np.all(inside):
+                outside = np.flatnonzero(~inside)
+
+                # read the points sorted by block, so that each block of the file is only read once
+                block_rows = np.floor(file_rows[outside] / self._block_shape[0])
+                block_cols = np.floor(file_cols[outside] / self._block_shape[1])
+                outside = outside[np.lexsort((block_cols, block_rows))]
+
+                elevations[outside] = [e[0] for e in self.dem.sample(zip(xs[outside], ys[outside]),
+                                                                      indexes=self._band)]
+
+            return elevations
+
+        # pixel centers are at .5
+        rows = rows - 0.5
+        cols = cols - 0.5
+
+        row_min, row_max, col_min, col_max = self._interp_bounds
+        if np.any((rows < row_min) | (rows > row_max) | (cols < col_min) | (cols > col_max)):
+            raise ValueError("Interpolated samples must lie inside of the DEM and its loaded window")
+
+        return self._interpolate(rows, cols)
 
     def elevation_profile(self, line: Union[LineString, GeoSeries], num_points: int = None, distance: float = 10, interpolated: bool = True) \
             -> ElevationProfile:
@@ -599,7 +721,15 @@ class DEM:
             raise "Cannot use num_points and distance at same time"
 
         if isinstance(line, gpd.GeoSeries):
-            if line.crs.to_epsg() != self.crs.to_epsg():
+            line_epsg = line.crs.to_epsg()
+
+            # crs without epsg code are compared directly
+            if line_epsg is None or self._epsg is None:
+                same_crs = line.crs == self.crs
+            else:
+                same_crs = line_epsg == self._epsg
+
+            if not same_crs:
                 line = line.to_crs(self.crs)
 
             line = line.iloc[0]
@@ -611,30 +741,49 @@ class DEM:
         else:
             distances = np.arange(0, line.length, distance)
 
-        sample_points = [line.interpolate(d) for d in distances] + [line.boundary[1]]
+        # the last sample point is the end of the line
+        distances = np.append(distances, line.length)
 
-        sample_point_x_coords = []
-        sample_point_y_coords = []
-        sample_point_elevation = []
+        sample_points = shapely.line_interpolate_point(line, distances)
+        xs = shapely.get_x(sample_points)
+        ys = shapely.get_y(sample_points)
 
-        for sample_point in sample_points:
-            p_x = sample_point.x
-            p_y = sample_point.y
+        elevations = self.sample_coords_batch(xs, ys, interpolated=interpolated)
 
-            sample_point_x_coords.append(p_x)
-            sample_point_y_coords.append(p_y)
-            sample_point_elevation.append(self.sample_coords(p_x, p_y, interpolated=interpolated))
+        return ElevationProfile(distances, elevations)
 
-        distances = np.append(distances, line.length)
-        elevations = np.array(sample_point_elevation)
 
-        return ElevationProfile(distances, elevations)
+@lru_cache(maxsize=8)
+def open_dem(file: str, elevation_band: int = 1) -> DEM:
+    """
+    Returns a shared DEM for the file, e.g. when many trips are sampled from the same file. The file is opened and the
+    elevation band is read only on the first call, later calls with the same arguments return the same DEM.
+
+    The cached DEMs keep their files open by design. They are closed only when the DEM drops out of the cache.
+
+    The band is read with a GDAL block cache of 512 MB and a VSI cache of 256 MB for remote files. These settings only
+    apply while the band is read and override the settings of the caller for that read.
+
+    Parameters
+    ----------
+        file : str
+            location to geotiff with elevation data
+        elevation_band : int
+            the band of the geotiff that contains the elevation
+
+    Returns
+    -------
+        DEM
+    """
+
+    with rasterio.Env(GDAL_CACHEMAX=512, VSI_CACHE=True, VSI_CACHE_SIZE=268435456):
+        return DEM(file, elevation_band)
 
 
-def _filter_overlapping(start_dists: List[float], end_dists: List[float]) -> Tuple[List[float], List[float]]:
+def _filter_overlapping(start_dists: ndarray, end_dists: ndarray) -> Tuple[ndarray, ndarray]:
     """
     From a list of intervals, defined by start and end dists, merges overlapping intervals and returns a set of
-    intervals that do not overlap.
+    intervals that do not overlap. The intervals must be sorted by start dist.
 
     Parameters
     ----------
@@ -645,26 +794,155 @@ def _filter_overlapping(start_dists: List[float], end_dists: List[float]) -> Tup
     -------
 
     """
-    # stack contains previous elements
-    start_dist_stack = []
-    end_dist_stack = []
+    start_dists = np.asarray(start_dists)
+    end_dists = np.asarray(end_dists)
+
+    if len(start_dists) == 0:
+        return start_dists, end_dists
+
+    # the end of the merged interval up to each interval
+    merged_ends = np.maximum.accumulate(end_dists)
+
+    # an interval starts a new merged interval if it starts after all previous intervals ended
+    is_first = np.empty(len(start_dists), dtype=bool)
+    is_first[0] = True
+    is_first[1:] = start_dists[1:] > merged_ends[:-1]
+
+    # the merged interval ends with the interval before the next first one
+    first_idx = np.flatnonzero(is_first)
+    last_idx = np.append(first_idx[1:] - 1, len(start_dists) - 1)
+
+    return start_dists[first_idx], merged_ends[last_idx]
+
+
+def _scan_brunnels(elevation: ndarray, diff: ndarray, thresh: float, max_brunnel_samples: int) \
+        -> Tuple[ndarray, ndarray, int]:
+    """
+    Finds the brunnels that should be constructed in steep regions. Downhill a bridge is constructed to the maximum,
+    uphill a tunnel is constructed to the minimum within the next max_brunnel_samples sample points.
+
+    Parameters
+    ----------
+        elevation : ndarray
+            the elevation profile
+        diff : ndarray
+            the elevation differences at each sample point
+        thresh : float
+            the absolute difference above which a brunnel is constructed
+        max_brunnel_samples : int
+            the maximum number of sample points a brunnel spans
+
+    Returns
+    -------
+        ndarray, ndarray, int
+        start and end indices of the brunnels and the number of brunnels found. Only the first n entries of the index
+        arrays are valid.
+    """
+
+    n = len(elevation)
+    start_idx = np.empty(n, dtype=np.int64)
+    end_idx = np.empty(n, dtype=np.int64)
+    n_brunnels = 0
+
+    for i in range(n - 1):
+
+        max_i = min(i + 1 + max_brunnel_samples, n)
+
+        # bridge when downhill
+        if diff[i] < -thresh:
+            assert i + 1 < max_i
+
+            # get the idx of the maximum in the next max_brunnel_samples
+            max_idx = np.argmax(elevation[i + 1:max_i]) + i + 1
+
+        # tunnel bei aufstieg
+        elif diff[i] > thresh:
+            assert i + 1 < max_i
+
+            # get the idx of the minimum in the next max_brunnel_samples
+            max_idx = np.argmin(elevation[i + 1:max_i]) + i + 1
+
+        else:
+            continue
+
+        start_idx[n_brunnels] = i
+        end_idx[n_brunnels] = max_idx
+        n_brunnels += 1
+
+    return start_idx, end_idx, n_brunnels
+
+
+if njit is not None:
+    _scan_brunnels = njit(cache=True, boundscheck=False)(_scan_brunnels)
+
+
+def _subtract_rolling_std(elevation: ndarray, window_size: int, std_thresh: float, sub_factor: float,
+                          clip: float) -> ndarray:
+    """
+    Subtracts the rolling standard deviation where it is above std_thresh. Same as pandas rolling(window_size).std(),
+    but the mean and the sum of squared differences of the window are updated in one pass (Welford). Windows that
+    contain nan are not adjusted.
+
+    Parameters
+    ----------
+        elevation : ndarray
+            the elevation profile
+        window_size : int
+            window size of the rolling window, the window ends at the sample point
+        std_thresh : float
+            if std above this value then subtract
+        sub_factor : float
+            the std is multiplied by this factor and subtracted
+        clip : float
+            the maximum value that is subtracted
+
+    Returns
+    -------
+        ndarray
+        the adjusted elevation
+    """
+
+    adjusted = elevation.copy()
+
+    # number of non nan values in the window, their mean and sum of squared differences
+    count = 0
+    mean = 0.0
+    m2 = 0.0
+
+    for i in range(len(elevation)):
+        x_new = elevation[i]
+
+        # add the new value to the window
+        if not np.isnan(x_new):
+            count += 1
+            delta = x_new - mean
+            mean += delta / count
+            m2 += delta * (x_new - mean)
+
+        # remove the oldest value from the window
+        if i >= window_size:
+            x_old = elevation[i - window_size]
 
-    start_dist_stack.append(start_dists[0])
-    end_dist_stack.append(end_dists[0])
+            if not np.isnan(x_old):
+                count -= 1
 
-    for i in range(0, len(start_dists)):
+                if count == 0:
+                    mean = 0.0
+                    m2 = 0.0
+                else:
+                    delta = x_old - mean
+                    mean -= delta / count
+                    m2 -= delta * (x_old - mean)
 
-        # check if not overlaps with stack top
-        if start_dists[i] > end_dist_stack[-1]:
+        # like pandas the std is only defined for windows without nan and with at least 2 values
+        if count == window_size and window_size > 1:
+            std = np.sqrt(max(m2, 0.0) / (window_size - 1))
 
-            # push to stack
-            start_dist_stack.append(start_dists[i])
-            end_dist_stack.append(end_dists[i])
+            if std > std_thresh:
+                adjusted[i] -= min(max(std * sub_factor, 0.0), clip)
 
-        # if overlaps with stack top and end dist is greater
-        elif start_dists[i] <= end_dist_stack[-1] < end_dists[i]:
+    return adjusted
 
-            # update the endtime of stack top
-            end_dist_stack[-1] = end_dists[i]
 
-    return start_dist_stack, end_dist_stack
+if njit is not None:
+    _subtract_rolling_std = njit(cache=True)(_subtract_rolling_std)
@@ -14,7 +14,10 @@ setup(name='ElevationSampler',
           'pandas',
           'numpy',
           'pyproj',
-          'shapely',
+          'shapely>=2.0',
           'scipy'
       ],
+      extras_require={
+          'numba': ['numba']
+      },
       zip_safe=True)